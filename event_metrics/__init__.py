@@ -1,3 +1,4 @@
 __version__ = "0.1.0"
 
 from event_metrics.connection import MetricConnection
+from event_metrics.query import Query, QueryBatch
@@ -1,13 +1,142 @@
-import itertools
-import json
+import atexit
+import os
+import queue
 import sqlite3
 import tempfile
-from pprint import pformat
-from typing import Any, Dict, Optional, Union
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple, Union
 
 from event_metrics.exceptions import MetricNotFound
-from event_metrics.query import Query, QueryBatch
-from event_metrics.utils import _current_time_us
+from event_metrics.query import Query, QueryBatch, _ResultCache
+from event_metrics.ring import RingBuffer
+from event_metrics.sketch import P2Quantile
+from event_metrics.utils import (
+    _CollectValues,
+    _current_time_us,
+    _find_metric_id,
+    _parse_labels,
+    _scalar_cursor,
+    _serialize_labels,
+)
+
+# UPDATE ... RETURNING lets increment() read back the new value in one statement.
+_HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+# Range of the integers sqlite can store.
+_MIN_INT64 = -(2**63)
+_MAX_INT64 = 2**63 - 1
+
+
+def _configure_connection(conn: sqlite3.Connection):
+    conn.executescript(
+        """
+-- In WAL mode, synchronous=NORMAL only syncs at checkpoints. Writes are
+-- nearly as fast as with syncing turned off, but a power loss can no
+-- longer corrupt the database.
+PRAGMA synchronous=normal;
+
+-- Keep the pages of recent scans resident: a 64MB page cache, memory
+-- mapped reads, and in-memory temporary tables.
+PRAGMA cache_size=-65536;
+PRAGMA mmap_size=2147483648;
+PRAGMA temp_store=memory;
+
+-- Wait for other writers instead of failing right away with SQLITE_BUSY.
+PRAGMA busy_timeout=5000;
+        """
+    )
+    conn.create_aggregate("collect_values", 1, _CollectValues)
+
+
+# The four tables.
+#   metric_names interns each metric name to an integer id.
+#   labels interns each serialized label set to an integer id.
+#   metrics is the source of truth.
+#   cache captures the _last_ items for each time series.
+_CREATE_TABLES_SQL = """
+-- Table for interning metric names
+CREATE TABLE IF NOT EXISTS metric_names (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+
+-- Table for interning label sets
+CREATE TABLE IF NOT EXISTS labels (
+    id INTEGER PRIMARY KEY,
+    labels_json TEXT NOT NULL UNIQUE
+);
+
+-- Table for recording the time series, clustered by series and time so that
+-- a range scan over a series reads contiguous pages in time order. seq only
+-- breaks ties between observations made in the same microsecond, numbering
+-- them from 0 in insertion order.
+CREATE TABLE IF NOT EXISTS metrics (
+    metric_id INTEGER NOT NULL,
+    metric_value REAL,
+    ingest_time_us INTEGER NOT NULL,
+    label_id INTEGER NOT NULL,
+    seq INTEGER NOT NULL,
+    PRIMARY KEY (metric_id, label_id, ingest_time_us, seq)
+) WITHOUT ROWID;
+
+-- Table for accessing latest value
+CREATE TABLE IF NOT EXISTS cache (
+    metric_id INTEGER NOT NULL,
+    metric_value REAL,
+    label_id INTEGER NOT NULL,
+    PRIMARY KEY (metric_id, label_id)
+);
+"""
+
+# Columns of the tables, checked when opening an existing database.
+_TABLE_COLUMNS = {
+    "metric_names": ["id", "name"],
+    "labels": ["id", "labels_json"],
+    "metrics": ["metric_id", "metric_value", "ingest_time_us", "label_id", "seq"],
+    "cache": ["metric_id", "metric_value", "label_id"],
+}
+
+# Inserts a (metric_id, value, ingest_time_us, label_id) row, with the next seq
+# of its series and microsecond. Writes hold sqlite's write lock, so no two
+# connections can hand out the same seq.
+_INSERT_METRIC_SQL = """
+INSERT INTO metrics VALUES (?1, ?2, ?3, ?4, (
+    SELECT coalesce(max(seq) + 1, 0) FROM metrics
+    WHERE metric_id = ?1 AND label_id = ?4 AND ingest_time_us = ?3
+))
+"""
+
+_DROP_TABLES_SQL = """
+DROP TABLE IF EXISTS metrics;
+DROP TABLE IF EXISTS cache;
+DROP TABLE IF EXISTS labels;
+DROP TABLE IF EXISTS metric_names;
+"""
+
+
+def _check_schema(conn: sqlite3.Connection):
+    for table, columns in _TABLE_COLUMNS.items():
+        found = [row[1] for row in conn.execute("PRAGMA table_info({})".format(table))]
+        if found != columns:
+            raise ValueError(
+                "Table {} has columns {}, expected {}. The database was created "
+                "by another version of event_metrics, open it with flush_db=True "
+                "to recreate it.".format(table, found, columns)
+            )
+
+
+def _is_json_path_key(key) -> bool:
+    # Keys are quoted verbatim into a JSON path, keep to what needs no escaping.
+    return isinstance(key, str) and key.isascii() and not any(c in key for c in '"\\')
+
+
+def _is_sql_scalar(value) -> bool:
+    # NULL never compares equal in SQL, and nested values are returned as JSON
+    # text by json_extract, so those are matched in Python instead. So are
+    # integers sqlite cannot bind.
+    if isinstance(value, int):
+        return _MIN_INT64 <= value <= _MAX_INT64
+    return isinstance(value, (str, float))
 
 
 class MetricConnection:
@@ -18,78 +147,247 @@ class MetricConnection:
           a temporary file will be created.
         flush_db(boolean, optional): Whether or not to flush the database
           before write. The default is True.
+        background_writer(boolean, optional): Whether to hand writes to a
+          background thread. observe() and increment() then only enqueue the
+          entry and return; the thread writes queued entries in batches.
+          Reads wait for the queue to drain first. The default is False.
+        track_percentiles(Iterable[float], optional): Percentiles to estimate
+          while observing, e.g. (50, 90, 99). Query.to_percentiles() over the
+          whole series returns the streaming estimates instead of reading
+          every value back. Requires flush_db, since the estimates only cover
+          the writes of this connection. The default is None.
+        ring_buffer_size(int, optional): Number of recent observations of each
+          series to keep in memory. Queries whose window only covers these
+          are answered without reading sqlite. Requires flush_db, for the
+          same reason. The default is 0, which keeps nothing.
+
+    The percentile estimates and ring buffers only see the writes of this
+    connection. They stop answering queries for good once another connection
+    writes to the database, or once a failed write is rolled back.
+
+    Repeated Query.to_percentiles() calls are served from a cache until the
+    metric is written to, or for at most METRICS_CACHE_TTL_SECONDS (default
+    1 second, 0 disables it). Results over a window relative to the current
+    time, like from_timedelta(), can therefore lag by up to that long.
     """
 
+    # Number of buffered observations that triggers a write inside a batch.
+    MAX_PENDING_ROWS = 1000
+    # Number of queued writes after which the background writer blocks callers.
+    MAX_QUEUED_WRITES = 100000
+
     def __init__(
         self,
         db_path: Union[str, None] = None,
         *,
         default_labels: Optional[Dict[str, Any]] = None,
         flush_db=True,
+        background_writer=False,
+        track_percentiles: Optional[Iterable[float]] = None,
+        ring_buffer_size: int = 0,
     ):
+        if (track_percentiles or ring_buffer_size) and not flush_db:
+            raise ValueError(
+                "track_percentiles and ring_buffer_size require flush_db=True, "
+                "existing values would be missing from memory."
+            )
         if db_path is None:
             _, db_path = tempfile.mkstemp(suffix=".event_metrics.db")
 
         self._conn = sqlite3.connect(
-            db_path, isolation_level=None  # Turn on autocommit mode
+            db_path,
+            isolation_level=None,  # Turn on autocommit mode
+            cached_statements=256,
+            # The background writer uses the connection from its own thread.
+            check_same_thread=not background_writer,
         )
 
-        if flush_db:
-            self._conn.execute("BEGIN TRANSACTION;")
-            self._conn.execute("DROP TABLE IF EXISTS metrics;")
-            self._conn.execute("DROP TABLE IF EXISTS cache;")
-            self._conn.commit()
+        _configure_connection(self._conn)
 
         # Turn on write-ahead-logging. In this mode, sqlite3 allows multi-reader
-        # single-writer concurrency.
-        self._conn.execute("pragma journal_mode=wal")
-
-        # Turn off synchrounous write to the OS. This makes write faster.
-        # The risk of intermediate data loss is not too bad because application
-        # level crash doesn't impact the integrity. It will only happen in power down event.
-        self._conn.execute("pragma synchronous=0")
-
-        # Create the two tables.
-        #   metrics is the source of truth.
-        #   cache captures the _last_ items for each time series.
+        # single-writer concurrency. Checkpoint every 1000 pages to keep the
+        # WAL file bounded.
         self._conn.executescript(
-            """
--- Table for recording the time series
-CREATE TABLE IF NOT EXISTS metrics (
-    metric_name TEXT NOT NULL,
-    metric_value REAL,
-    ingest_time_us INTEGER,
-    labels_json TEXT NOT NULL
-);
+            "PRAGMA journal_mode=wal; PRAGMA wal_autocheckpoint=1000;"
+        )
 
--- Table for accessing latest value
-CREATE TABLE IF NOT EXISTS cache (
-    metric_name TEXT NOT NULL,
-    metric_value REAL,
-    labels_json TEXT NOT NULL,
-    PRIMARY KEY (metric_name, labels_json)
-);
-        """
+        # Drop and create the tables in one transaction, so that opening a
+        # connection commits once instead of once per statement.
+        self._conn.executescript(
+            "BEGIN;"
+            + (_DROP_TABLES_SQL if flush_db else "")
+            + _CREATE_TABLES_SQL
+            + "COMMIT;"
         )
+        if not flush_db:
+            try:
+                _check_schema(self._conn)
+            except ValueError:
+                self._conn.close()
+                raise
+
+        # Maps metric names to their id in the metric_names table.
+        self._metric_ids: Dict[str, int] = dict()
+        # Maps serialized labels to their id in the labels table.
+        self._label_ids: Dict[str, int] = dict()
+        # Maps serialized labels to the parsed dictionary.
+        self._parsed_labels: Dict[str, Any] = dict()
+        # Maps metric id to the serialized labels and label id of its series.
+        # Loaded from the cache table on first query, then kept up to date by
+        # the writes of this connection. Reloaded once another connection
+        # writes to the database, which changes its data_version.
+        self._labels_by_metric: Dict[int, Dict[str, int]] = dict()
+        self._data_version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+
+        # Label matching is pushed down to sqlite when the JSON1 functions are
+        # compiled in, which is the default since sqlite 3.38.
+        try:
+            self._conn.execute("SELECT json('{}')")
+            self._has_json1 = True
+        except sqlite3.OperationalError:
+            self._has_json1 = False
 
         self.in_batch_context = False
         self.in_batch_context_entry_count = 0
 
+        # Observations waiting to be written, as
+        # (metric_id, value, timestamp, label_id).
+        self._pending: List[Tuple[int, Optional[float], int, int]] = []
+        # Streaming percentile estimates of each (metric_id, label_id) series,
+        # or None once the series holds a value the estimates cannot follow.
+        self._track_percentiles = tuple(track_percentiles or ())
+        self._sketches: Dict[Tuple[int, int], Optional[Dict[float, P2Quantile]]] = {}
+        # Recent observations of each (metric_id, label_id) series.
+        self._ring_buffer_size = ring_buffer_size
+        self._rings: Dict[Tuple[int, int], RingBuffer] = {}
+        self._keeps_values = bool(self._track_percentiles or ring_buffer_size)
+
+        self._result_cache = _ResultCache(
+            float(os.environ.get("METRICS_CACHE_TTL_SECONDS", 1.0))
+        )
+        # Metrics written in the open transaction, invalidated again on commit.
+        self._uncommitted_metrics: Set[int] = set()
+
         self.default_labels = default_labels or dict()
 
+        # Guards the series bookkeeping shared with the background writer.
+        self._lock = threading.Lock()
+        self._writer: Optional[threading.Thread] = None
+        self._closed = False
+        self._read_conn = self._conn
+        if background_writer:
+            # Readers use their own connection so they never wait on the writer.
+            self._read_conn = sqlite3.connect(
+                db_path, isolation_level=None, cached_statements=256
+            )
+            _configure_connection(self._read_conn)
+            self._read_conn.execute("pragma query_only=1")
+
+            self._queue: queue.Queue = queue.Queue(maxsize=self.MAX_QUEUED_WRITES)
+            self._writer_error: Optional[Exception] = None
+            self._writer = threading.Thread(
+                target=self._write_loop, name="event_metrics-writer", daemon=True
+            )
+            self._writer.start()
+            atexit.register(self.close)
+
     def __enter__(self):
-        """Enter batch commit context"""
+        """Enter batch commit context.
+
+        Observations recorded inside the context are buffered and written in
+        bulk when the outermost context exits, or whenever the buffer holds
+        ``MAX_PENDING_ROWS`` rows.
+        """
+        if not self.in_batch_context and self._writer is None:
+            # Take the write lock upfront rather than upgrading from a read
+            # lock on the first write, which can fail with SQLITE_BUSY. The
+            # flags are only set once the lock is held.
+            self._conn.execute("BEGIN IMMEDIATE TRANSACTION")
         self.in_batch_context_entry_count += 1
-        if not self.in_batch_context:
-            self.in_batch_context = True
-            self._conn.execute("BEGIN TRANSACTION")
+        self.in_batch_context = True
 
     def __exit__(self, exc_type, exc_value, traceback):
         self.in_batch_context_entry_count -= 1
         if self.in_batch_context:  # The flag is on
             if self.in_batch_context_entry_count == 0:  # we are top level
-                self._conn.commit()
                 self.in_batch_context = False
+                if self._writer is None:
+                    try:
+                        self._flush()
+                        self._commit()
+                    except BaseException:
+                        # Keep the connection usable, without the failed batch.
+                        self._rollback()
+                        raise
+                else:
+                    # The writer batches on its own, wait for it to catch up.
+                    self.flush()
+
+    def close(self):
+        """Close the database connection. Closing again does nothing."""
+        if self._closed:
+            return
+        self._closed = True
+        if self._writer is not None:
+            self._queue.put((None, None))
+            self._writer.join()
+            atexit.unregister(self.close)
+            self._read_conn.close()
+        # Let sqlite refresh the query planner statistics before leaving.
+        self._conn.execute("PRAGMA optimize")
+        self._conn.close()
+
+    def flush(self):
+        """Write out every buffered entry, waiting for the background writer."""
+        if self._writer is None:
+            self._flush()
+            return
+        self._queue.join()
+        if self._writer_error is not None:
+            error, self._writer_error = self._writer_error, None
+            raise error
+
+    def _prepare_read(self):
+        """Make the writes of this connection visible to a query about to read,
+        and forget what the writes of other connections made stale.
+        """
+        self.flush()
+        with self._lock:
+            self._check_other_writers()
+
+    def _write_loop(self):
+        """Write queued (function, args) entries, one transaction per batch."""
+        while True:
+            entries = [self._queue.get()]
+            while len(entries) < self.MAX_PENDING_ROWS:
+                try:
+                    entries.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            try:
+                with self._lock:
+                    try:
+                        self._conn.execute("BEGIN IMMEDIATE TRANSACTION")
+                        for function, args in entries:
+                            if function is None:
+                                continue
+                            try:
+                                function(*args)
+                            except Exception as error:
+                                self._writer_error = error
+                        self._flush()
+                        self._commit()
+                    except Exception as error:
+                        # Drop the batch but keep the thread alive for the next.
+                        self._writer_error = error
+                        self._rollback()
+            finally:
+                # Waiting callers must wake up whatever happened to the batch.
+                for _ in entries:
+                    self._queue.task_done()
+            if any(function is None for function, _ in entries):
+                return
 
     def begin_transaction(self):
         self.__enter__()
@@ -97,6 +395,168 @@ CREATE TABLE IF NOT EXISTS cache (
     def commit(self):
         self.__exit__(None, None, None)
 
+    def _commit(self):
+        self._conn.commit()
+        # A reader on another connection may have cached a result computed
+        # before the commit under the version bumped by the write.
+        for metric_id in self._uncommitted_metrics:
+            self._result_cache.invalidate(metric_id)
+        self._uncommitted_metrics.clear()
+
+    def _invalidate_results(self, metric_ids: Iterable[int]):
+        """Drop the cached results of written metrics, again once committed."""
+        for metric_id in metric_ids:
+            self._result_cache.invalidate(metric_id)
+            self._uncommitted_metrics.add(metric_id)
+
+    def _flush(self):
+        """Write the buffered observations to the database."""
+        if len(self._pending) == 0:
+            return
+        self._conn.executemany(_INSERT_METRIC_SQL, self._pending)
+        self._invalidate_results({row[0] for row in self._pending})
+        # Only the last value of each series needs to reach the cache.
+        latest_values = {
+            (metric_id, label_id): value
+            for metric_id, value, _, label_id in self._pending
+        }
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO cache VALUES (?, ?, ?)",
+            [
+                (metric_id, value, label_id)
+                for (metric_id, label_id), value in latest_values.items()
+            ],
+        )
+        self._pending.clear()
+
+    def _rollback(self):
+        """Abandon the open transaction and the buffered rows after a failed write."""
+        self._pending.clear()
+        if self._conn.in_transaction:
+            self._conn.rollback()
+        # Names and labels interned inside the transaction are gone with it.
+        self._metric_ids.clear()
+        self._label_ids.clear()
+        self._labels_by_metric.clear()
+        self._result_cache.clear()
+        self._uncommitted_metrics.clear()
+        # The in-memory views may hold rolled back values, stop serving them.
+        self._stop_percentile_sketches()
+        self._stop_ring_buffers()
+
+    def _stop_percentile_sketches(self):
+        """Stop keeping and serving percentile estimates for good."""
+        for sketches in self._sketches.values():
+            if sketches is not None:
+                # Queries already holding the sketches go back to sqlite.
+                sketches.clear()
+        self._sketches.clear()
+        self._track_percentiles = ()
+
+    def _stop_ring_buffers(self):
+        """Stop keeping and serving ring buffers for good."""
+        for ring in self._rings.values():
+            # Queries already holding the ring go back to sqlite.
+            ring.invalidate()
+        self._rings.clear()
+        self._ring_buffer_size = 0
+
+    def _check_other_writers(self):
+        """Drop the state kept in memory if another connection wrote."""
+        data_version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+        if data_version == self._data_version:
+            return
+        self._data_version = data_version
+        self._labels_by_metric.clear()
+        self._result_cache.clear()
+        self._stop_percentile_sketches()
+        self._stop_ring_buffers()
+
+    def _check_bindable(self, value):
+        """Raise the error sqlite would raise when binding value."""
+        if type(value) is float or value is None:
+            return
+        if isinstance(value, int):
+            if not _MIN_INT64 <= value <= _MAX_INT64:
+                raise OverflowError("Python int too large to convert to SQLite INTEGER")
+        elif not isinstance(value, (str, bytes)):
+            # Other types need an adapter, leave it to sqlite to look one up.
+            self._conn.execute("SELECT ?", (value,))
+
+    def _serialize_labels(self, labels: Union[Dict[str, Any], None]) -> str:
+        if self.default_labels:
+            labels = {**self.default_labels, **(labels or dict())}
+        return _serialize_labels(labels)
+
+    def _get_metric_id(self, name: str) -> int:
+        """Return the interned id for the metric name, creating it if needed."""
+        metric_id = self._metric_ids.get(name)
+        if metric_id is None:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO metric_names (name) VALUES (?)", (name,)
+            )
+            metric_id = _find_metric_id(self._conn, name)
+            self._metric_ids[name] = metric_id
+        return metric_id
+
+    def _get_label_id(self, labels_json: str) -> int:
+        """Return the interned id for the serialized labels, creating it if needed."""
+        label_id = self._label_ids.get(labels_json)
+        if label_id is None:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO labels (labels_json) VALUES (?)", (labels_json,)
+            )
+            label_id = (
+                _scalar_cursor(self._conn)
+                .execute("SELECT id FROM labels WHERE labels_json = ?", (labels_json,))
+                .fetchone()
+            )
+            self._label_ids[labels_json] = label_id
+        return label_id
+
+    def _series_labels(self, metric_id: int) -> Dict[str, int]:
+        """Return the serialized labels and label id of every series of a metric."""
+        series = self._labels_by_metric.get(metric_id)
+        if series is None:
+            cursor = self._read_conn.execute(
+                "SELECT labels.labels_json, cache.label_id FROM cache "
+                "JOIN labels ON labels.id = cache.label_id WHERE cache.metric_id = ?",
+                (metric_id,),
+            )
+            series = dict(cursor.fetchall())
+            if len(series) != 0:
+                self._labels_by_metric[metric_id] = series
+        return series
+
+    def _remember_series(self, metric_id: int, labels_json: str, label_id: int):
+        series = self._labels_by_metric.get(metric_id)
+        if series is not None:
+            series[labels_json] = label_id
+
+    def _keep_value(self, metric_id: int, label_id: int, value, ingest_time_us: int):
+        """Add an observation to the in-memory views of its series."""
+        if self._track_percentiles:
+            self._add_to_sketches(metric_id, label_id, value)
+        if self._ring_buffer_size:
+            key = (metric_id, label_id)
+            if key not in self._rings:
+                self._rings[key] = RingBuffer(self._ring_buffer_size)
+            self._rings[key].add(value, ingest_time_us)
+
+    def _add_to_sketches(self, metric_id: int, label_id: int, value):
+        key = (metric_id, label_id)
+        if key not in self._sketches:
+            self._sketches[key] = {p: P2Quantile(p) for p in self._track_percentiles}
+        sketches = self._sketches[key]
+        if sketches is None:
+            return
+        if value is None:
+            # np.percentile returns NaN for a series holding NULL values.
+            self._sketches[key] = None
+            return
+        for sketch in sketches.values():
+            sketch.add(value)
+
     def observe(
         self,
         name: str,
@@ -116,25 +576,57 @@ CREATE TABLE IF NOT EXISTS cache (
             ingest_time_us(int, None): Used for testing, if not None, this field overrides the
                 default ingestion time, which is the time observe() method is called.
         """
-        if ingest_time_us is None:
-            ingest_time_us = _current_time_us()
+        self.observe_many([(name, value, ingest_time_us, labels)])
 
-        labels_json = json.dumps(
-            {**self.default_labels, **(labels or dict())}, sort_keys=True
-        )
-        data = dict(
-            name=name, value=value, timestamp=ingest_time_us, labels_json=labels_json
-        )
+    def observe_many(
+        self,
+        rows: Iterable[
+            Tuple[str, Optional[float], Optional[int], Optional[Dict[str, Any]]]
+        ],
+    ):
+        """Record many metric entries in a single transaction.
 
-        with self:
-            self._conn.execute(
-                "INSERT INTO metrics VALUES (:name, :value, :timestamp, :labels_json)",
-                data,
-            )
-            self._conn.execute(
-                "INSERT OR REPLACE INTO cache VALUES (:name, :value, :labels_json)",
-                data,
+        Example:
+            >>> conn.observe_many([("latency", 1.2, None, {"route": "/"})])
+
+        Args:
+            rows(Iterable[tuple]): (name, value, ingest_time_us, labels) tuples,
+                with the same meaning as the arguments of observe(). Rows
+                without an ingest_time_us get the time of this call.
+        """
+        # Stamp the ingestion time now rather than when the row is written.
+        # A single reading serves the whole call, the seq column keeps rows
+        # sharing it in order.
+        now_us = _current_time_us()
+        rows = [
+            (
+                name,
+                value,
+                now_us if ingest_time_us is None else ingest_time_us,
+                labels,
             )
+            for name, value, ingest_time_us, labels in rows
+        ]
+        if self._writer is not None:
+            self._queue.put((self._observe_rows, (rows,)))
+            return
+        with self:
+            self._observe_rows(rows)
+
+    def _observe_rows(self, rows):
+        for name, value, ingest_time_us, labels in rows:
+            # A row sqlite rejects fails this call, not the batch it joins.
+            self._check_bindable(value)
+            self._check_bindable(ingest_time_us)
+            metric_id = self._get_metric_id(name)
+            labels_json = self._serialize_labels(labels)
+            label_id = self._get_label_id(labels_json)
+            self._remember_series(metric_id, labels_json, label_id)
+            self._pending.append((metric_id, value, ingest_time_us, label_id))
+            if self._keeps_values:
+                self._keep_value(metric_id, label_id, value, ingest_time_us)
+            if len(self._pending) >= self.MAX_PENDING_ROWS:
+                self._flush()
 
     def increment(
         self,
@@ -164,39 +656,138 @@ CREATE TABLE IF NOT EXISTS cache (
         if ingest_time_us is None:
             ingest_time_us = _current_time_us()
 
-        labels_json = json.dumps(
-            {**self.default_labels, **(labels or dict())}, sort_keys=True
-        )
+        if self._writer is not None:
+            self._queue.put((self._increment, (name, delta, labels, ingest_time_us)))
+            return
+        with self:
+            self._increment(name, delta, labels, ingest_time_us)
+
+    def _increment(self, name, delta, labels, ingest_time_us):
+        # Buffered observations must land before reading back the cache
+        self._flush()
+        metric_id = self._get_metric_id(name)
+        self._invalidate_results([metric_id])
+        labels_json = self._serialize_labels(labels)
+        label_id = self._get_label_id(labels_json)
+        self._remember_series(metric_id, labels_json, label_id)
+        if _HAS_RETURNING:
+            # Add delta to the cached value, starting from 0 for a new series,
+            # and read back the result in a single statement.
+            (value,) = self._conn.execute(
+                "INSERT INTO cache VALUES (?, ?, ?) "
+                "ON CONFLICT (metric_id, label_id) DO UPDATE "
+                "SET metric_value = metric_value + excluded.metric_value "
+                "RETURNING metric_value",
+                (metric_id, delta, label_id),
+            ).fetchone()
+            self._conn.execute(
+                _INSERT_METRIC_SQL, (metric_id, value, ingest_time_us, label_id)
+            )
+            if self._keeps_values:
+                self._keep_value(metric_id, label_id, value, ingest_time_us)
+            return
+
         data = dict(
-            name=name,
+            metric_id=metric_id,
             delta=delta,
             timestamp=ingest_time_us,
-            labels_json=labels_json,
+            label_id=label_id,
             default_counter=0,
         )
-
-        with self:
-            # If the value doesn't exist, populate the cache
-            self._conn.execute(
-                "INSERT OR IGNORE INTO cache VALUES (:name, :default_counter, :labels_json)",
-                data,
-            )
-            self._conn.execute(
-                "UPDATE cache SET metric_value = metric_value + :delta "
-                "WHERE metric_name = :name and labels_json = :labels_json",
-                data,
-            )
-            # Now the cache is populated, we insert the new value into time series table
-            self._conn.execute(
-                """
+        # If the value doesn't exist, populate the cache
+        self._conn.execute(
+            "INSERT OR IGNORE INTO cache VALUES "
+            "(:metric_id, :default_counter, :label_id)",
+            data,
+        )
+        self._conn.execute(
+            "UPDATE cache SET metric_value = metric_value + :delta "
+            "WHERE metric_id = :metric_id and label_id = :label_id",
+            data,
+        )
+        # Now the cache is populated, we insert the new value into time series table
+        self._conn.execute(
+            """
     INSERT INTO metrics VALUES (
-    :name,
-    (SELECT metric_value FROM cache WHERE metric_name = :name),
+    :metric_id,
+    (SELECT metric_value FROM cache
+     WHERE metric_id = :metric_id AND label_id = :label_id),
     :timestamp,
-    :labels_json);
+    :label_id,
+    (SELECT coalesce(max(seq) + 1, 0) FROM metrics
+     WHERE metric_id = :metric_id AND label_id = :label_id
+     AND ingest_time_us = :timestamp));
         """,
-                data,
+            data,
+        )
+        if self._keeps_values:
+            value = (
+                _scalar_cursor(self._conn)
+                .execute(
+                    "SELECT metric_value FROM cache "
+                    "WHERE metric_id = :metric_id AND label_id = :label_id",
+                    data,
+                )
+                .fetchone()
             )
+            self._keep_value(metric_id, label_id, value, ingest_time_us)
+
+    def _match_labels_sql(
+        self, metric_id: int, query_labels: Dict[str, Any]
+    ) -> List[Tuple[str, int]]:
+        """Find the series containing query_labels, using JSON1."""
+        sql = (
+            "SELECT labels.labels_json, cache.label_id FROM cache "
+            "JOIN labels ON labels.id = cache.label_id "
+            "WHERE cache.metric_id = ? AND labels.labels_json != 'null'"
+        )
+        params = [metric_id]
+        for key, value in query_labels.items():
+            sql += " AND json_extract(labels.labels_json, ?) = ?"
+            params.extend(['$."{}"'.format(key), value])
+        return self._read_conn.execute(sql, params).fetchall()
+
+    def _match_labels(
+        self, all_labels: Iterable[str], query_labels: Dict[str, Any]
+    ) -> List[str]:
+        """Find the labels of series containing query_labels, in Python."""
+        # Perform multi-dimensional matching
+        # Following comments are examples of successful match
+
+        matched_series_labels = []
+        for labels_json in all_labels:
+            # {"route": "/index", "error_code": "404"}
+            series_labels = self._parsed_labels.get(labels_json)
+            if series_labels is None:
+                series_labels = _parse_labels(labels_json)
+                self._parsed_labels[labels_json] = series_labels
+            # {"error_code"}
+            query_keys = set(query_labels.keys())
+            # {"error_code"}
+            series_key = set(series_labels.keys())
+            # {"error_code"}
+            key_matches = series_key.intersection(query_keys)
+            if key_matches == query_keys:
+                # {"error_code": "404"}
+                matched_sub_dict = {
+                    k: v for k, v in series_labels.items() if k in key_matches
+                }
+                if matched_sub_dict == query_labels:
+                    matched_series_labels.append(labels_json)
+        return matched_series_labels
+
+    def _make_query(self, name, metric_id: int, labels, label_id: int) -> Query:
+        return Query(
+            self._read_conn,
+            name,
+            labels=labels,
+            label_id=label_id,
+            metric_id=metric_id,
+            percentile_sketches=self._sketches.get((metric_id, label_id)),
+            result_cache=self._result_cache,
+            ring=self._rings.get((metric_id, label_id)),
+            before_read=self._prepare_read,
+        )
 
     def query(self, name, *, labels: Union[str, Dict[str, str], None] = "*"):
         """Start a query. To continue, calls from_* and to_* method to compute the final value.
@@ -214,10 +805,15 @@ CREATE TABLE IF NOT EXISTS cache (
                 - None: Return the default null label. Returns a single query.
                 - Dict[str, str]: Perform multi-dimensional label mathcing. Returns a batch.
         """
-        cursor = self._conn.execute(
-            "SELECT labels_json FROM cache WHERE metric_name = ?", (name,)
-        )
-        all_labels = set(itertools.chain.from_iterable(cursor.fetchall()))
+        self._prepare_read()
+        with self._lock:
+            metric_id = self._metric_ids.get(name)
+            if metric_id is None:
+                metric_id = _find_metric_id(self._read_conn, name)
+            # Maps serialized labels to label id
+            all_labels = (
+                {} if metric_id is None else dict(self._series_labels(metric_id))
+            )
 
         # Post processing all_labels
         if len(all_labels) == 0:
@@ -227,63 +823,66 @@ CREATE TABLE IF NOT EXISTS cache (
         if isinstance(labels, str) and labels == "*":
             # If there is only one items, squeeze the batch into single query
             if len(all_labels) == 1:
-                return Query(self._conn, name, labels=all_labels.pop())
+                ((labels_json, label_id),) = all_labels.items()
+                return self._make_query(name, metric_id, labels_json, label_id)
 
             return QueryBatch(
-                [Query(self._conn, name, labels=labels) for labels in all_labels]
+                self._read_conn,
+                name,
+                list(all_labels.items()),
+                metric_id=metric_id,
+                before_read=self._prepare_read,
             )
         elif labels is None:
             if "null" in all_labels:
-                return Query(self._conn, name, labels=labels)
+                return self._make_query(name, metric_id, labels, all_labels["null"])
             else:
                 raise MetricNotFound(
                     "Metric {} doesn't series associated with default label. The labels are {}".format(
-                        name, all_labels
+                        name, set(all_labels)
                     )
                 )
         elif isinstance(labels, dict):
             if "null" in all_labels and len(all_labels) > 0:
-                all_labels.remove("null")
+                all_labels.pop("null")
 
-            # Perform multi-dimensional matching
-            # Following comments are examples of successful match
-
-            # {"error_code": "404"}
             query_labels = labels
-
-            matched_series_labels = []
-            for labels_json in all_labels:
-                # {"route": "/index", "error_code": "404"}
-                series_labels = json.loads(labels_json)
-                # {"error_code"}
-                query_keys = set(query_labels.keys())
-                # {"error_code"}
-                series_key = set(series_labels.keys())
-                # {"error_code"}
-                key_matches = series_key.intersection(query_keys)
-                if key_matches == query_keys:
-                    # {"error_code": "404"}
-                    matched_sub_dict = {
-                        k: v for k, v in series_labels.items() if k in key_matches
-                    }
-                    if matched_sub_dict == query_labels:
-                        matched_series_labels.append(series_labels)
-
-            if len(matched_series_labels) == 0:
+            matched_series = None
+            if self._has_json1 and all(
+                _is_json_path_key(key) and _is_sql_scalar(value)
+                for key, value in query_labels.items()
+            ):
+                # Label ids come from the database too, so series written by
+                # other connections since all_labels was read still resolve.
+                try:
+                    matched_series = self._match_labels_sql(metric_id, query_labels)
+                except sqlite3.OperationalError:
+                    # json_extract rejects the NaN and Infinity json.dumps
+                    # writes for non-finite label values.
+                    pass
+            if matched_series is None:
+                matched_series = [
+                    (labels_json, all_labels[labels_json])
+                    for labels_json in self._match_labels(all_labels, query_labels)
+                ]
+
+            if len(matched_series) == 0:
                 raise MetricNotFound(
                     "Metric {} with label {} cannot be found. The labels corresponding "
                     "to the name are: \n{}".format(
-                        name, query_labels, pformat(all_labels)
+                        name, query_labels, sorted(all_labels)
                     )
                 )
-            elif len(matched_series_labels) == 1:
-                return Query(self._conn, name, labels=matched_series_labels.pop())
+            elif len(matched_series) == 1:
+                ((labels_json, label_id),) = matched_series
+                return self._make_query(name, metric_id, labels_json, label_id)
             else:
                 return QueryBatch(
-                    [
-                        Query(self._conn, name, labels=series_labels)
-                        for series_labels in matched_series_labels
-                    ]
+                    self._read_conn,
+                    name,
+                    matched_series,
+                    metric_id=metric_id,
+                    before_read=self._prepare_read,
                 )
 
         else:
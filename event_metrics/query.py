@@ -1,51 +1,160 @@
 import datetime
-import json
-from typing import Dict, List, Tuple, Union
+import functools
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 
 import numpy as np
 
-from event_metrics.utils import _current_time_us
-
-
-class Query:
-    def __init__(
-        self, conn, metric_name, labels: Union[Dict[str, str], None, str] = None
-    ):
-        self._conn = conn
+from event_metrics.ring import RingBuffer
+from event_metrics.sketch import P2Quantile
+from event_metrics.utils import (
+    _current_time_us,
+    _find_metric_id,
+    _scalar_cursor,
+    _serialize_labels,
+    _to_local_datetime64,
+)
+
+# Record layouts for streaming result rows straight into numpy arrays.
+_VALUE_DTYPE = np.dtype([("value", np.float64)])
+_TIMESTAMP_DTYPE = np.dtype([("timestamp", np.int64)])
+_VALUE_TIMESTAMP_DTYPE = np.dtype([("value", np.float64), ("timestamp", np.int64)])
+
+# Keeps QueryBatch statements below sqlite's limit on bound parameters.
+_MAX_SERIES_PER_STATEMENT = 512
+# QueryBatch pads its list of series to one of these sizes, so only a few
+# distinct statements exist and sqlite3's statement cache keeps hitting.
+_SERIES_PER_STATEMENT_SIZES = [8, 32, 128, _MAX_SERIES_PER_STATEMENT]
+
+# Number of results kept by a _ResultCache before it starts over.
+_MAX_CACHED_RESULTS = 1024
+
+# Projection used by to_scaler() for each aggregation.
+_AGGREGATE_PROJECTIONS = {
+    "min": "min(metric_value)",
+    "max": "max(metric_value)",
+    "mean": "avg(metric_value)",
+    "count": "count(metric_value)",
+    "sum": "sum(metric_value)",
+}
+
+_FETCH_SQL = """
+SELECT {} FROM metrics
+WHERE metric_id = ?
+AND label_id = ?
+AND ingest_time_us > ?
+ORDER BY ingest_time_us, seq
+"""
+
+
+_BATCH_FETCH_SQL = """
+SELECT label_id, {} FROM metrics
+WHERE metric_id = ?
+AND label_id IN ({})
+AND ingest_time_us > ?
+ORDER BY label_id, ingest_time_us, seq
+"""
+
+_BATCH_AGGREGATE_SQL = """
+SELECT label_id, {} FROM metrics
+WHERE metric_id = ?
+AND label_id IN ({})
+AND ingest_time_us > ?
+GROUP BY label_id
+"""
+
+_BATCH_LAST_SQL = """
+SELECT label_id, {} FROM cache
+WHERE metric_id = ?
+AND label_id IN ({})
+"""
+
+
+@functools.lru_cache(maxsize=None)
+def _batch_statement(template: str, projection_clause: str, num_series: int) -> str:
+    return template.format(projection_clause, ", ".join("?" * num_series))
+
+
+def _pad_label_ids(label_ids: List[int]) -> Tuple[int, List[int]]:
+    """Pad label_ids with -1, an id that matches no rows, to a statement size."""
+    num_series = next(
+        size for size in _SERIES_PER_STATEMENT_SIZES if size >= len(label_ids)
+    )
+    return num_series, label_ids + [-1] * (num_series - len(label_ids))
+
+
+def _metric_id_or_missing(conn, metric_name, metric_id: Optional[int]) -> int:
+    if metric_id is None:
+        metric_id = _find_metric_id(conn, metric_name)
+    # An id that matches no rows, so that queries return empty results.
+    return -1 if metric_id is None else metric_id
+
+
+class _ResultCache:
+    """Recent aggregation results of a connection, dropped on writes.
+
+    An entry is served while its metric has no new writes and it is younger
+    than ttl_s. The age limit matters for windows relative to the current
+    time, which move even without writes. A ttl_s of 0 turns caching off.
+    """
+
+    def __init__(self, ttl_s: float):
+        self.ttl_s = ttl_s
+        # Write counter of each metric id.
+        self._versions: Dict[int, int] = dict()
+        # Maps a query key to (creation time, metric version, result).
+        self._entries: Dict[tuple, Tuple[float, int, Any]] = dict()
+        # The writer and reader threads of a connection share the cache.
+        self._lock = threading.Lock()
+
+    def invalidate(self, metric_id: int):
+        with self._lock:
+            self._versions[metric_id] = self._versions.get(metric_id, 0) + 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def get_or_compute(self, metric_id: int, key: tuple, compute: Callable):
+        if self.ttl_s <= 0:
+            return compute()
+
+        now = time.monotonic()
+        with self._lock:
+            version = self._versions.get(metric_id, 0)
+            entry = self._entries.get(key)
+        if entry is None or entry[1] != version or now - entry[0] >= self.ttl_s:
+            # Computed without the lock. A write meanwhile bumps the version,
+            # so the entry stored under the version read above goes stale.
+            entry = (now, version, compute())
+            with self._lock:
+                if len(self._entries) >= _MAX_CACHED_RESULTS:
+                    self._entries.clear()
+                self._entries[key] = entry
+        # Results are arrays, hand out copies so callers cannot alter the entry.
+        return entry[2].copy()
+
+
+class _TimeWindow:
+    """Selection of the time range to aggregate, shared by Query and QueryBatch."""
+
+    def __init__(self, before_read: Optional[Callable[[], None]] = None):
         self._construction_time = _current_time_us()
-        self._metric_name = metric_name
         self._time_cutoff_us = 0
+        # Identifies the window independently of the construction time.
+        self._window_key = ("cutoff", 0)
+        # Called before each read, so the connection can write buffered rows.
+        self._before_read = before_read
 
-        if isinstance(labels, str):  # already serialized
-            self.labels = labels
-        else:
-            self.labels = json.dumps(labels, sort_keys=True)
-
-    def _fetch_array(self, projection_clause):
-        data = dict(
-            name=self._metric_name,
-            cutoff=self._time_cutoff_us,
-            labels=self.labels,
-        )
-        result_cursor = self._conn.execute(
-            """
-SELECT {} FROM metrics
-WHERE metric_name = :name
-AND ingest_time_us > :cutoff
-AND labels_json = :labels
-ORDER BY ingest_time_us
-        """.format(
-                projection_clause
-            ),
-            data,
-        )
-
-        result_list = result_cursor.fetchall()
-        return result_list
+    def _prepare_read(self):
+        if self._before_read is not None:
+            self._before_read()
 
     def from_beginning(self):
         # start from the epoch, this is a noop because the default curoff is 0
         self._time_cutoff_us = 0
+        self._window_key = ("cutoff", 0)
         return self
 
     def from_timestamp(self, timestamp: Union[datetime.datetime, float]):
@@ -54,122 +163,359 @@ ORDER BY ingest_time_us
         ), "Please use datetime.datetime object or floating point to indicate timestamp"
 
         if isinstance(timestamp, datetime.datetime):
-            self._time_cutoff_us = int(timestamp.timestamp() * 1e6)
+            self._time_cutoff_us = int(timestamp.timestamp() * 1_000_000)
 
         if isinstance(timestamp, float):
-            self._time_cutoff_us = int(timestamp * 1e6)
+            self._time_cutoff_us = int(timestamp * 1_000_000)
 
+        self._window_key = ("cutoff", self._time_cutoff_us)
         return self
 
     def from_timedelta(self, delta: datetime.timedelta):
         assert isinstance(delta, datetime.timedelta)
-        self._time_cutoff_us = self._construction_time - (delta.total_seconds() * 1e6)
+        delta_us = (
+            delta.days * 86_400_000_000 + delta.seconds * 1_000_000 + delta.microseconds
+        )
+        self._time_cutoff_us = self._construction_time - delta_us
+        self._window_key = ("delta", delta_us)
         return self
 
+
+class Query(_TimeWindow):
+    # The statement text of every projection is built once, so that sqlite3's
+    # statement cache hits on each call.
+    _FETCH_STATEMENTS = {
+        projection_clause: _FETCH_SQL.format(projection_clause)
+        for projection_clause in [
+            "metric_value",
+            "ingest_time_us",
+            "metric_value, ingest_time_us",
+            "collect_values(metric_value)",
+            *_AGGREGATE_PROJECTIONS.values(),
+        ]
+    }
+
+    def __init__(
+        self,
+        conn,
+        metric_name,
+        labels: Union[Dict[str, str], None, str] = None,
+        label_id: Optional[int] = None,
+        metric_id: Optional[int] = None,
+        percentile_sketches: Optional[Dict[float, P2Quantile]] = None,
+        result_cache: Optional[_ResultCache] = None,
+        ring: Optional[RingBuffer] = None,
+        before_read: Optional[Callable[[], None]] = None,
+    ):
+        super().__init__(before_read)
+        self._conn = conn
+        self._metric_name = metric_name
+        self._metric_id = _metric_id_or_missing(conn, metric_name, metric_id)
+        # Streaming estimates covering every value of the series, if tracked.
+        self._percentile_sketches = percentile_sketches
+        self._result_cache = result_cache
+        # Recent observations of the series kept in memory, if any.
+        self._ring = ring
+
+        if isinstance(labels, str):  # already serialized
+            self.labels = labels
+        else:
+            self.labels = _serialize_labels(labels)
+
+        if label_id is None:
+            label_id = (
+                _scalar_cursor(self._conn)
+                .execute("SELECT id FROM labels WHERE labels_json = ?", (self.labels,))
+                .fetchone()
+            )
+            if label_id is None:
+                label_id = -1
+        self._label_id = label_id
+
+    def _execute(self, projection_clause, cursor=None):
+        return (cursor or self._conn).execute(
+            self._FETCH_STATEMENTS[projection_clause],
+            (self._metric_id, self._label_id, self._time_cutoff_us),
+        )
+
+    def _fetch_array(self, projection_clause, dtype: np.dtype) -> np.ndarray:
+        if self._ring is not None and self._ring.covers(self._time_cutoff_us):
+            values, timestamps = self._ring.window(self._time_cutoff_us)
+            records = np.empty(len(values), dtype=dtype)
+            if "value" in dtype.names:
+                records["value"] = values
+            if "timestamp" in dtype.names:
+                records["timestamp"] = timestamps
+            return records
+
+        # Rows are copied straight from the cursor into a record array, there
+        # is no intermediate list of tuples. NULL values become NaN.
+        if len(dtype) == 1:
+            # A single column is read as scalars, skipping the tuple per row.
+            cursor = self._execute(projection_clause, _scalar_cursor(self._conn))
+            return np.fromiter(cursor, dtype=dtype[0]).view(dtype)
+        return np.fromiter(self._execute(projection_clause), dtype=dtype)
+
+    def _fetch_values_unordered(self) -> np.ndarray:
+        """Fetch the values of the window, for aggregations ignoring order."""
+        if self._ring is not None and self._ring.covers(self._time_cutoff_us):
+            return self._fetch_array("metric_value", _VALUE_DTYPE)
+        # The collect_values aggregate hands every value over as one blob.
+        cursor = _scalar_cursor(self._conn)
+        blob = self._execute("collect_values(metric_value)", cursor).fetchone()
+        if blob is None:  # The aggregate is NULL when no rows match
+            return np.empty(0, dtype=_VALUE_DTYPE)
+        return np.frombuffer(blob, dtype=_VALUE_DTYPE)
+
     def to_scaler(self, agg="last") -> Union[None, float]:
         agg = agg.lower()
-        assert agg in {"last", "min", "max", "mean", "count", "sum"}
+        assert agg == "last" or agg in _AGGREGATE_PROJECTIONS
 
+        self._prepare_read()
+        cursor = _scalar_cursor(self._conn)
         if agg == "last":  # Fetch from cache for the latest value
-            result = self._conn.execute(
-                "SELECT metric_value FROM cache WHERE metric_name = ?",
-                (self._metric_name,),
+            return cursor.execute(
+                "SELECT metric_value FROM cache WHERE metric_id = ? AND label_id = ?",
+                (self._metric_id, self._label_id),
             ).fetchone()
-            return result[0] if result is not None else None
         else:
-            result = self._fetch_array("{agg}(metric_value)".format(agg=agg))
-            return result[0][0] if len(result) != 0 else None
+            return self._execute(_AGGREGATE_PROJECTIONS[agg], cursor).fetchone()
 
     def to_buckets(self, buckets=[0, 0.5, 1.0, 5.0, 10, 100, np.inf], cumulative=False):
-        result = self._fetch_array("metric_value")
-        if len(result) == 0:
-            return np.array([])
-
-        counts, buckets = np.histogram(result, bins=buckets)
-        if cumulative:
-            counts = np.cumsum(counts)
-        return counts
-
-    def to_percentiles(self, percentiles=[50, 90, 95, 99]):
-        result = self._fetch_array("metric_value")
-        if len(result) == 0:
-            return np.array([])
-        return np.percentile(result, percentiles)
+        self._prepare_read()
+        return _to_buckets(self._fetch_values_unordered(), buckets, cumulative)
+
+    def to_percentiles(self, percentiles=[50, 90, 95, 99], *, dtype=np.float64):
+        """Compute the percentiles of the values in the window.
+
+        Pass dtype=np.float32 to compute on float32 values, which is faster on
+        large series at a relative error around 1e-7. Stored values are not
+        affected.
+        """
+        self._prepare_read()
+        # A single percentile is accepted too, like np.percentile does.
+        flat_percentiles = np.atleast_1d(percentiles).tolist()
+        sketches = self._percentile_sketches
+        if (
+            sketches is not None
+            and self._time_cutoff_us == 0
+            and all(p in sketches for p in flat_percentiles)
+        ):
+            estimates = np.array(
+                [sketches[p].value() for p in flat_percentiles], dtype=dtype
+            )
+            # Indexing with () turns a 0-d array into a scalar.
+            return estimates.reshape(np.shape(percentiles))[()]
+
+        def compute():
+            return _to_percentiles(self._fetch_values_unordered(), percentiles, dtype)
+
+        if self._result_cache is None:
+            return compute()
+        key = (
+            self._metric_id,
+            self._label_id,
+            self._window_key,
+            "percentiles",
+            np.shape(percentiles),
+            tuple(flat_percentiles),
+            np.dtype(dtype).str,
+        )
+        return self._result_cache.get_or_compute(self._metric_id, key, compute)
 
     def to_array(self) -> np.ndarray:
-        result = self._fetch_array("metric_value")
-        return np.array(result).reshape(-1) if len(result) != 0 else np.array([])
+        self._prepare_read()
+        return self._fetch_array("metric_value", _VALUE_DTYPE)["value"]
 
     def to_timestamps_array(self) -> Tuple[np.ndarray, np.ndarray]:
-        result = self._fetch_array("metric_value, ingest_time_us")
-        if len(result) == 0:
-            return np.array([]), np.array([])
-        data, ts = np.array(result).T
-        # Casting is necessary because the value can be "string" due to data can be "None"
-        datetime_64 = np.array(
-            [
-                datetime.datetime.fromtimestamp(timestamp_us / 1e6)
-                for timestamp_us in ts
-            ],
-            dtype="datetime64",
+        self._prepare_read()
+        return _to_timestamps_array(
+            self._fetch_array("metric_value, ingest_time_us", _VALUE_TIMESTAMP_DTYPE)
         )
-        return datetime_64, data
 
     def to_timestamps(self) -> np.ndarray:
-        result = self._fetch_array("ingest_time_us")
-        datetime_64 = np.array(
-            [
-                datetime.datetime.fromtimestamp(timestamp_us / 1e6)
-                for timestamp_us in np.array(result).reshape(-1)
-            ],
-            dtype="datetime64",
-        )
-        return datetime_64 if len(datetime_64) != 0 else np.array([])
+        self._prepare_read()
+        return _to_timestamps(self._fetch_array("ingest_time_us", _TIMESTAMP_DTYPE))
+
+
+def _to_buckets(records: np.ndarray, buckets, cumulative) -> np.ndarray:
+    if len(records) == 0:
+        return np.array([])
+
+    counts, buckets = np.histogram(records["value"], bins=buckets)
+    if cumulative:
+        counts = np.cumsum(counts)
+    return counts
+
+
+def _to_percentiles(records: np.ndarray, percentiles, dtype=np.float64) -> np.ndarray:
+    if len(records) == 0:
+        return np.array([], dtype=dtype)
+    values = records["value"].astype(dtype, copy=False)
+    return np.percentile(values, percentiles).astype(dtype, copy=False)
+
+
+def _to_timestamps_array(records: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    if len(records) == 0:
+        return np.array([]), np.array([])
+    return _to_local_datetime64(records["timestamp"]), records["value"]
+
 
+def _to_timestamps(records: np.ndarray) -> np.ndarray:
+    if len(records) == 0:
+        return np.array([])
+    return _to_local_datetime64(records["timestamp"])
 
-class QueryBatch:
-    def __init__(self, queries: List[Query]):
-        self.queries = queries
+
+class QueryBatch(_TimeWindow):
+    """Queries over several series of the same metric.
+
+    Series are kept as (serialized labels, label id) pairs; Query objects are
+    only created for the methods that need them, so preparing a batch over
+    many series is cheap.
+    """
+
+    def __init__(
+        self,
+        conn,
+        metric_name,
+        series: List[Tuple[str, int]],
+        metric_id: Optional[int] = None,
+        before_read: Optional[Callable[[], None]] = None,
+    ):
+        super().__init__(before_read)
+        self._conn = conn
+        self._metric_name = metric_name
+        self._metric_id = _metric_id_or_missing(conn, metric_name, metric_id)
+        self._series = series
 
     def __len__(self):
-        return len(self.queries)
+        return len(self._series)
+
+    def _make_query(self, labels_json: str, label_id: int) -> Query:
+        query = Query(
+            self._conn,
+            self._metric_name,
+            labels=labels_json,
+            label_id=label_id,
+            metric_id=self._metric_id,
+            before_read=self._before_read,
+        )
+        query._construction_time = self._construction_time
+        query._time_cutoff_us = self._time_cutoff_us
+        query._window_key = self._window_key
+        return query
 
-    def _make_query_result_batch(self, make_result_lambda):
+    @property
+    def queries(self) -> List[Query]:
         return [
-            {"labels": query.labels, "result": make_result_lambda(query)}
-            for query in self.queries
+            self._make_query(labels_json, label_id)
+            for labels_json, label_id in self._series
         ]
 
-    def from_beginning(self):
-        self.queries = [query.from_beginning() for query in self.queries]
-        return self
+    def _label_id_chunks(self):
+        """Yield the label ids of the series, _MAX_SERIES_PER_STATEMENT at a time."""
+        for i in range(0, len(self._series), _MAX_SERIES_PER_STATEMENT):
+            yield [
+                label_id
+                for _, label_id in self._series[i : i + _MAX_SERIES_PER_STATEMENT]
+            ]
+
+    def _fetch_all(self, projection_clause, dtype: np.dtype) -> List[np.ndarray]:
+        """Fetch the rows of every series in the batch with one statement per
+        _MAX_SERIES_PER_STATEMENT series.
+
+        Returns one record array per series, in the same order as the series.
+        """
+        records = []
+        for label_ids in self._label_id_chunks():
+            records.extend(self._fetch_chunk(label_ids, projection_clause, dtype))
+        return records
+
+    def _fetch_chunk(
+        self, label_ids: List[int], projection_clause, dtype: np.dtype
+    ) -> List[np.ndarray]:
+        batch_dtype = np.dtype([("label_id", np.int64)] + dtype.descr)
+        num_series, padded_label_ids = _pad_label_ids(label_ids)
+        result_cursor = self._conn.execute(
+            _batch_statement(_BATCH_FETCH_SQL, projection_clause, num_series),
+            [self._metric_id, *padded_label_ids, self._time_cutoff_us],
+        )
+        result = np.fromiter(result_cursor, dtype=batch_dtype)
 
-    def from_timestamp(self, timestamp: Union[datetime.datetime, float]):
-        self.queries = [query.from_timestamp(timestamp) for query in self.queries]
-        return self
+        # Rows are sorted by series, so each series' rows are a contiguous
+        # slice that can be located with binary searches.
+        starts = np.searchsorted(result["label_id"], label_ids, "left")
+        ends = np.searchsorted(result["label_id"], label_ids, "right")
+        records = result[list(dtype.names)]
+        return [records[start:end] for start, end in zip(starts, ends)]
 
-    def from_timedelta(self, delta: datetime.timedelta):
-        self.queries = [query.from_timedelta(delta) for query in self.queries]
-        return self
+    def _make_fetched_result_batch(
+        self, projection_clause, dtype: np.dtype, make_result_lambda
+    ):
+        self._prepare_read()
+        return [
+            {"labels": labels_json, "result": make_result_lambda(records)}
+            for (labels_json, _), records in zip(
+                self._series, self._fetch_all(projection_clause, dtype)
+            )
+        ]
 
     def to_scaler(self, agg="last"):
-        return self._make_query_result_batch(lambda query: query.to_scaler(agg))
+        agg = agg.lower()
+        assert agg == "last" or agg in _AGGREGATE_PROJECTIONS
+
+        self._prepare_read()
+        # One grouped statement per chunk of series instead of one per series.
+        results = dict()
+        for label_ids in self._label_id_chunks():
+            num_series, padded_label_ids = _pad_label_ids(label_ids)
+            if agg == "last":  # Fetch from cache for the latest value
+                statement = _batch_statement(
+                    _BATCH_LAST_SQL, "metric_value", num_series
+                )
+                params = [self._metric_id, *padded_label_ids]
+            else:
+                statement = _batch_statement(
+                    _BATCH_AGGREGATE_SQL, _AGGREGATE_PROJECTIONS[agg], num_series
+                )
+                params = [self._metric_id, *padded_label_ids, self._time_cutoff_us]
+            results.update(self._conn.execute(statement, params))
+
+        # Series without rows in the window get what a single Query returns.
+        default = 0 if agg == "count" else None
+        return [
+            {"labels": labels_json, "result": results.get(label_id, default)}
+            for labels_json, label_id in self._series
+        ]
 
     def to_buckets(self, buckets=[0, 0.5, 1.0, 5.0, 10, 100, np.inf], cumulative=False):
-        return self._make_query_result_batch(
-            lambda query: query.to_buckets(buckets, cumulative)
+        return self._make_fetched_result_batch(
+            "metric_value",
+            _VALUE_DTYPE,
+            lambda records: _to_buckets(records, buckets, cumulative),
         )
 
-    def to_percentiles(self, percentiles=[50, 90, 95, 99]):
-        return self._make_query_result_batch(
-            lambda query: query.to_percentiles(percentiles)
+    def to_percentiles(self, percentiles=[50, 90, 95, 99], *, dtype=np.float64):
+        return self._make_fetched_result_batch(
+            "metric_value",
+            _VALUE_DTYPE,
+            lambda records: _to_percentiles(records, percentiles, dtype),
         )
 
     def to_array(self):
-        return self._make_query_result_batch(lambda query: query.to_array())
+        return self._make_fetched_result_batch(
+            "metric_value", _VALUE_DTYPE, lambda records: records["value"]
+        )
 
     def to_timestamps_array(self):
-        return self._make_query_result_batch(lambda query: query.to_timestamps_array())
+        return self._make_fetched_result_batch(
+            "metric_value, ingest_time_us",
+            _VALUE_TIMESTAMP_DTYPE,
+            _to_timestamps_array,
+        )
 
     def to_timestamps(self):
-        return self._make_query_result_batch(lambda query: query.to_timestamps())
+        return self._make_fetched_result_batch(
+            "ingest_time_us", _TIMESTAMP_DTYPE, _to_timestamps
+        )
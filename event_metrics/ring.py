@@ -0,0 +1,69 @@
+import threading
+from typing import Tuple
+
+import numpy as np
+
+
+class RingBuffer:
+    """The most recent observations of a series, in columnar numpy arrays.
+
+    Keeps the last `capacity` values and timestamps. A window can be read from
+    memory when it starts at or after every timestamp evicted so far, since
+    no row of the window is missing then.
+
+    Args:
+        capacity(int): Number of observations to keep.
+    """
+
+    def __init__(self, capacity: int):
+        assert capacity > 0
+        self.capacity = capacity
+        self._values = np.empty(capacity, dtype=np.float64)
+        self._timestamps = np.empty(capacity, dtype=np.int64)
+        # Total number of observations added, the next slot is at head % capacity.
+        self._head = 0
+        self._evicted_max_timestamp = np.iinfo(np.int64).min
+        self._is_sorted = True
+        # Observations are added by the writing thread while queries read.
+        self._lock = threading.Lock()
+
+    def add(self, value, timestamp_us: int):
+        with self._lock:
+            slot = self._head % self.capacity
+            if self._head >= self.capacity:
+                self._evicted_max_timestamp = max(
+                    self._evicted_max_timestamp, self._timestamps[slot]
+                )
+            if self._head > 0 and timestamp_us < self._timestamps[slot - 1]:
+                self._is_sorted = False
+            self._values[slot] = np.nan if value is None else value
+            self._timestamps[slot] = timestamp_us
+            self._head += 1
+
+    def invalidate(self):
+        """Mark the buffer incomplete, so that it covers no window anymore."""
+        with self._lock:
+            self._evicted_max_timestamp = np.iinfo(np.int64).max
+
+    def covers(self, cutoff_us: int) -> bool:
+        """Whether every observation after cutoff_us is still in the buffer."""
+        return cutoff_us >= self._evicted_max_timestamp
+
+    def window(self, cutoff_us: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Return the values and timestamps after cutoff_us, in time order."""
+        with self._lock:
+            if self._head <= self.capacity:
+                values = self._values[: self._head].copy()
+                timestamps = self._timestamps[: self._head].copy()
+            else:  # Unroll from the oldest slot
+                oldest = self._head % self.capacity
+                values = np.roll(self._values, -oldest)
+                timestamps = np.roll(self._timestamps, -oldest)
+            is_sorted = self._is_sorted
+
+        if not is_sorted:
+            # Ties keep insertion order, like the seq column in sqlite.
+            order = np.argsort(timestamps, kind="stable")
+            values, timestamps = values[order], timestamps[order]
+        start = np.searchsorted(timestamps, cutoff_us, "right")
+        return values[start:], timestamps[start:]
@@ -0,0 +1,88 @@
+from bisect import bisect_right
+from typing import List
+
+import numpy as np
+
+
+class P2Quantile:
+    """Streaming estimate of a single percentile with the P-square algorithm.
+
+    The estimate is kept in five markers updated in constant time and memory
+    per observation (Jain and Chlamtac, 1985). The first five observations are
+    kept as is, so the percentile of up to five values is exact.
+
+    Args:
+        percentile(float): The percentile to estimate, between 0 and 100.
+    """
+
+    def __init__(self, percentile: float):
+        assert 0 <= percentile <= 100
+        self.percentile = percentile
+        p = percentile / 100
+
+        # Marker heights, which are the first observations until there are five.
+        self._heights: List[float] = []
+        # Actual and desired marker positions, zero based.
+        self._positions = [0, 1, 2, 3, 4]
+        self._desired = [0, 2 * p, 4 * p, 2 + 2 * p, 4]
+        self._increments = [0, p / 2, p, (1 + p) / 2, 1]
+
+    def add(self, value: float):
+        heights = self._heights
+        if len(heights) < 5:
+            heights.append(value)
+            heights.sort()
+            return
+
+        # Find the cell the value falls in, extending the extreme markers.
+        if value < heights[0]:
+            heights[0] = value
+            cell = 0
+        elif value >= heights[4]:
+            heights[4] = value
+            cell = 3
+        else:
+            cell = bisect_right(heights, value) - 1
+
+        positions = self._positions
+        for i in range(cell + 1, 5):
+            positions[i] += 1
+        for i in range(5):
+            self._desired[i] += self._increments[i]
+
+        # Move the middle markers towards their desired positions.
+        for i in (1, 2, 3):
+            offset = self._desired[i] - positions[i]
+            if (offset >= 1 and positions[i + 1] - positions[i] > 1) or (
+                offset <= -1 and positions[i - 1] - positions[i] < -1
+            ):
+                step = 1 if offset > 0 else -1
+                height = self._parabolic(i, step)
+                if not heights[i - 1] < height < heights[i + 1]:
+                    height = self._linear(i, step)
+                heights[i] = height
+                positions[i] += step
+
+    def _parabolic(self, i: int, step: int) -> float:
+        q, n = self._heights, self._positions
+        return q[i] + step / (n[i + 1] - n[i - 1]) * (
+            (n[i] - n[i - 1] + step) * (q[i + 1] - q[i]) / (n[i + 1] - n[i])
+            + (n[i + 1] - n[i] - step) * (q[i] - q[i - 1]) / (n[i] - n[i - 1])
+        )
+
+    def _linear(self, i: int, step: int) -> float:
+        q, n = self._heights, self._positions
+        return q[i] + step * (q[i + step] - q[i]) / (n[i + step] - n[i])
+
+    def value(self) -> float:
+        """Return the current estimate, NaN if nothing was added."""
+        if len(self._heights) == 0:
+            return np.nan
+        if self._positions[4] == 4:  # Five observations or less
+            return float(np.percentile(self._heights, self.percentile))
+        # The extreme markers track the minimum and maximum exactly.
+        if self.percentile == 0:
+            return self._heights[0]
+        if self.percentile == 100:
+            return self._heights[4]
+        return self._heights[2]
@@ -1,5 +1,119 @@
+import array
+import functools
+import json
+import sqlite3
 import time
+from typing import Any, Dict, Tuple, Union
+
+import numpy as np
+
+try:
+    from orjson import loads as _fast_json_loads
+except ImportError:  # orjson is optional
+    _fast_json_loads = json.loads
+
+# UTC offsets only change on quarter hour boundaries.
+_UTC_OFFSET_PERIOD_S = 15 * 60
 
 
 def _current_time_us():
-    return int(time.time() * 1e6)
+    return time.time_ns() // 1000
+
+
+def _first_column(cursor, row):
+    return row[0]
+
+
+def _scalar_cursor(conn: sqlite3.Connection) -> sqlite3.Cursor:
+    """Return a cursor yielding the first column of each row instead of a tuple."""
+    cursor = conn.cursor()
+    cursor.row_factory = _first_column
+    return cursor
+
+
+class _CollectValues:
+    """sqlite aggregate packing a REAL column into float64 bytes.
+
+    Reading a column through it costs one Python call per row and a single
+    result row, which is cheaper than stepping a cursor row by row.
+    """
+
+    def __init__(self):
+        self._values = array.array("d")
+
+    def step(self, value):
+        try:
+            self._values.append(value)
+        except TypeError:  # NULL
+            self._values.append(np.nan)
+
+    def finalize(self) -> bytes:
+        return self._values.tobytes()
+
+
+def _find_metric_id(conn: sqlite3.Connection, name: str) -> Union[int, None]:
+    """Return the interned id of a metric name, or None if it was never recorded."""
+    return (
+        _scalar_cursor(conn)
+        .execute("SELECT id FROM metric_names WHERE name = ?", (name,))
+        .fetchone()
+    )
+
+
+@functools.lru_cache(maxsize=4096)
+def _canonical_labels(items: Tuple[Tuple[str, Any], ...], value_types: tuple) -> str:
+    # value_types is only part of the cache key: 1, 1.0 and True compare equal
+    # but serialize differently.
+    return json.dumps(dict(items), sort_keys=True)
+
+
+def _serialize_labels(labels: Union[Dict[str, Any], None]) -> str:
+    """Serialize labels into the canonical JSON form used as the series key.
+
+    Label sets repeat across every observation of a series, so the
+    serialization is memoized on the sorted items. Missing or empty labels
+    map to "null".
+    """
+    if not labels:
+        return "null"
+    try:
+        items = tuple(sorted(labels.items()))
+        return _canonical_labels(items, tuple(type(value) for _, value in items))
+    except TypeError:  # unhashable or unorderable label values
+        return json.dumps(labels, sort_keys=True)
+
+
+def _parse_labels(labels_json: str) -> Any:
+    """Parse serialized labels, using orjson when it is installed.
+
+    Serialization stays with the json module: orjson writes a different
+    canonical form, which would change the key of existing series.
+    """
+    try:
+        return _fast_json_loads(labels_json)
+    except ValueError:  # orjson rejects the NaN and Infinity json.dumps writes
+        return json.loads(labels_json)
+
+
+def _to_local_datetime64(timestamps_us: np.ndarray) -> np.ndarray:
+    """Convert epoch microseconds to naive local time datetime64 values.
+
+    This matches datetime.fromtimestamp() element-wise, but the UTC offset
+    is looked up once per quarter hour present in the input instead of once
+    per element.
+    """
+    timestamps_us = np.asarray(timestamps_us, dtype=np.int64)
+    periods, inverse = np.unique(
+        timestamps_us // (_UTC_OFFSET_PERIOD_S * 1000000), return_inverse=True
+    )
+    offsets_us = (
+        np.array(
+            [
+                time.localtime(period * _UTC_OFFSET_PERIOD_S).tm_gmtoff
+                for period in periods.tolist()
+            ],
+            dtype=np.int64,
+        )
+        * 1000000
+    )
+    return (timestamps_us + offsets_us[inverse.reshape(-1)]).astype("datetime64[us]")
@@ -26,12 +26,12 @@ setup(
     name='event_metrics',
     version='0.2.0',
     description='An embedded, event-time metric collection library',
-    python_requires='==3.*,>=3.5.0',
+    python_requires='==3.*,>=3.7.0',
     author='simon-mo',
     author_email='xmo@berkeley.edu',
     packages=['event_metrics'],
     package_dir={"": "."},
     package_data={},
     install_requires=['numpy'],
-    extras_require={"dev": ["pytest==5.*,>=5.2.0", "pytest-benchmark==3.*,>=3.2.2", "pytest-sugar==0.*,>=0.9.2"]},
+    extras_require={"orjson": ["orjson"], "dev": ["pytest==5.*,>=5.2.0", "pytest-benchmark==3.*,>=3.2.2", "pytest-sugar==0.*,>=0.9.2"]},
 )
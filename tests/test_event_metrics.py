@@ -1,12 +1,20 @@
+import decimal
+import json
 import random
+import sqlite3
 import time
 from datetime import datetime, timedelta
 
 import numpy as np
 import pytest
 
-from event_metrics import MetricConnection
+from event_metrics import MetricConnection, Query
 from event_metrics.exceptions import MetricNotFound
+from event_metrics.utils import (
+    _parse_labels,
+    _serialize_labels,
+    _to_local_datetime64,
+)
 
 
 def test_increment(metric_conn: MetricConnection):
@@ -16,6 +24,17 @@ def test_increment(metric_conn: MetricConnection):
     assert metric_conn.query("counter").to_scaler() == 2
 
 
+def test_increment_labels(metric_conn: MetricConnection):
+    metric_conn.increment("counter", 5, labels={"route": "/a"})
+    metric_conn.increment("counter", 1, labels={"route": "/b"})
+    metric_conn.increment("counter", -3, labels={"route": "/a"})
+
+    query = metric_conn.query("counter", labels={"route": "/a"})
+    assert query.to_array().tolist() == [5, 2]
+    assert query.to_scaler() == 2
+    assert metric_conn.query("counter", labels={"route": "/b"}).to_scaler() == 1
+
+
 def test_observe_null(metric_conn: MetricConnection):
     metric_conn.observe("obs", ingest_time_us=1e6)
     metric_conn.observe("obs", ingest_time_us=2e6)
@@ -31,6 +50,8 @@ def test_return_scalers(metric_conn: MetricConnection):
     query = metric_conn.query("lat")
     assert query.to_scaler(agg="last") == 2.0
     assert query.to_scaler(agg="min") == 1.0
+    assert query.to_scaler(agg="mean") == 1.5
+    assert query.to_scaler(agg="count") == 2
 
 
 def test_return_buckets(metric_conn: MetricConnection):
@@ -55,6 +76,132 @@ def test_return_percentiles(metric_conn: MetricConnection):
     assert perc.tolist() == [50, 90, 99]
 
 
+def test_track_percentiles():
+    conn = MetricConnection(track_percentiles=(0, 50, 90, 99, 100))
+    values = list(range(1001))
+    random.shuffle(values)
+    conn.observe_many([("lat", value, value + 1, None) for value in values])
+
+    query = conn.query("lat")
+    estimates = query.to_percentiles([50, 90, 99])
+    assert np.allclose(estimates, [500, 900, 990], rtol=0.02)
+    assert np.isscalar(query.to_percentiles(50))
+    assert query.to_percentiles([0, 100]).tolist() == [0, 1000]
+    assert query._percentile_sketches is not None
+    # Untracked percentiles and narrower windows read the values back
+    assert query.to_percentiles([50, 75]).tolist() == [500, 750]
+    assert query.from_timestamp(500 / 1e6).to_percentiles([50]).tolist() == [750]
+
+    # A NULL value stops the estimates for the series
+    conn.observe("lat", None)
+    assert np.isnan(conn.query("lat").to_percentiles([50])).all()
+
+    with pytest.raises(ValueError):
+        MetricConnection(flush_db=False, track_percentiles=(50,))
+
+
+def test_percentiles_result_cache(metric_conn: MetricConnection):
+    for i in range(0, 101):
+        metric_conn.observe("lat", i)
+    query = metric_conn.query("lat").from_timedelta(timedelta(hours=1))
+    assert query.to_percentiles([50]).tolist() == [50]
+    # Served from the cache: a hit does not read the values back
+    query._fetch_array = None
+    result = query.to_percentiles([50])
+    assert result.tolist() == [50]
+    result[0] = -1
+    assert query.to_percentiles([50]).tolist() == [50]
+
+    # Writes to the metric drop the cached results
+    metric_conn.observe("lat", 1000)
+    query = metric_conn.query("lat").from_timedelta(timedelta(hours=1))
+    assert query.to_percentiles([50]).tolist() == [50.5]
+
+    # A single percentile gives a scalar, from the cache as well
+    assert query.to_percentiles(50) == 50.5
+    assert query.to_percentiles(50) == 50.5
+
+
+def test_empty_window_aggregates(metric_conn: MetricConnection):
+    metric_conn.observe("lat", 1.0, ingest_time_us=1)
+    query = metric_conn.query("lat").from_timedelta(timedelta(seconds=1))
+    assert query.to_percentiles().tolist() == []
+    assert query.to_buckets().tolist() == []
+
+
+def test_percentiles_dtype(metric_conn: MetricConnection):
+    metric_conn.observe_many([("lat", i / 7, None, None) for i in range(1000)])
+    query = metric_conn.query("lat").from_timedelta(timedelta(hours=1))
+    expected = query.to_percentiles([50, 99])
+    result = query.to_percentiles([50, 99], dtype=np.float32)
+    assert result.dtype == np.float32
+    assert np.allclose(result, expected, rtol=1e-6)
+    # Cached per dtype
+    assert query.to_percentiles([50, 99]).dtype == np.float64
+
+
+def test_ring_buffer():
+    conn = MetricConnection(ring_buffer_size=10)
+    # Out of order timestamps, including a tie
+    timestamps = [5, 1, 3, 2, 4, 9, 7, 8, 6, 10, 14, 12, 13, 11, 15, 15]
+    for i, ts in enumerate(timestamps):
+        conn.observe("lat", i, ingest_time_us=ts * 1e6)
+
+    def from_sqlite(cutoff_s):
+        query = Query(conn._read_conn, "lat").from_timestamp(cutoff_s)
+        return query.to_timestamps_array()
+
+    # The ring holds the last 10 observations, the newest evicted one is at 9s
+    query = conn.query("lat").from_timestamp(9.0)
+    query._execute = None  # Served from memory
+    timestamps, values = query.to_timestamps_array()
+    expected_timestamps, expected_values = from_sqlite(9.0)
+    assert values.tolist() == expected_values.tolist() == [9, 13, 11, 12, 10, 14, 15]
+    assert timestamps.tolist() == expected_timestamps.tolist()
+
+    # Older windows read sqlite
+    query = conn.query("lat").from_timestamp(8.0)
+    assert query.to_array().tolist() == from_sqlite(8.0)[1].tolist()
+
+
+def test_ring_buffer_other_writer(tmp_path):
+    db_path = str(tmp_path / "metrics.db")
+    conn = MetricConnection(db_path, ring_buffer_size=100)
+    conn.observe_many([("lat", i, i + 1, None) for i in range(5)])
+    query = conn.query("lat")
+    assert query._ring.covers(0)
+
+    other = MetricConnection(db_path, flush_db=False)
+    other.observe_many([("lat", i, i + 1, None) for i in range(5, 10)])
+    assert conn.query("lat").to_array().tolist() == list(range(10))
+    assert query.to_array().tolist() == list(range(10))
+
+
+def test_track_percentiles_other_writer(tmp_path):
+    db_path = str(tmp_path / "metrics.db")
+    conn = MetricConnection(db_path, track_percentiles=(50,))
+    conn.observe_many([("lat", i, None, None) for i in range(5)])
+    query = conn.query("lat")
+    assert query.to_percentiles([50]).tolist() == [2]
+
+    other = MetricConnection(db_path, flush_db=False)
+    other.observe_many([("lat", 100, None, None) for i in range(5)])
+    assert conn.query("lat").to_percentiles([50]).tolist() == [52]
+    assert query.to_percentiles([50]).tolist() == [52]
+
+
+def test_percentiles_result_cache_other_writer(tmp_path):
+    db_path = str(tmp_path / "metrics.db")
+    conn = MetricConnection(db_path)
+    conn.observe_many([("lat", i, None, None) for i in range(5)])
+    query = conn.query("lat")
+    assert query.to_percentiles([50]).tolist() == [2]
+
+    other = MetricConnection(db_path, flush_db=False)
+    other.observe_many([("lat", 100, None, None) for i in range(5)])
+    assert query.to_percentiles([50]).tolist() == [52]
+
+
 def test_return_array(metric_conn: MetricConnection):
     metric_conn.observe("lat", 1.0)
     metric_conn.observe("lat", 2.0)
@@ -81,6 +228,14 @@ def test_return_timestamps_array(metric_conn: MetricConnection):
     ]
 
 
+def test_to_local_datetime64():
+    # A week of timestamps, so a daylight saving change can fall in range
+    timestamps_us = np.arange(0, 7 * 24 * 3600 * 1000000, 3599999999) + int(1.7e15)
+    expected = [datetime.fromtimestamp(ts // 1000000) for ts in timestamps_us]
+    result = _to_local_datetime64(timestamps_us - timestamps_us % 1000000)
+    assert result.tolist() == expected
+
+
 def test_projection(metric_conn: MetricConnection):
     # Ingest in order:
     # Time---1---2---3
@@ -149,6 +304,266 @@ def test_label_mechanism(metric_conn: MetricConnection):
     assert len(metric_conn.query("latency", labels={"code": "200"})) == 3
 
 
+def test_label_interning(metric_conn: MetricConnection):
+    metric_conn.observe("lat", 1.0, labels={"route": "/a"})
+    metric_conn.observe("lat", 2.0, labels={"route": "/b"})
+    metric_conn.observe("lat", 3.0, labels={"route": "/a"})
+
+    (num_labels,) = metric_conn._conn.execute("SELECT COUNT(*) FROM labels").fetchone()
+    assert num_labels == 2
+
+    assert metric_conn.query("lat", labels={"route": "/a"}).to_scaler() == 3.0
+    assert metric_conn.query("lat", labels={"route": "/b"}).to_scaler() == 2.0
+
+
+def test_metric_name_interning(metric_conn: MetricConnection):
+    metric_conn.observe("lat", 1.0)
+    metric_conn.observe("lat", 2.0, labels={"route": "/a"})
+    metric_conn.increment("counter")
+
+    names = metric_conn._conn.execute("SELECT name FROM metric_names").fetchall()
+    assert sorted(names) == [("counter",), ("lat",)]
+
+    assert metric_conn.query("lat", labels=None).to_scaler() == 1.0
+    assert metric_conn.query("counter").to_scaler() == 1
+    with pytest.raises(MetricNotFound):
+        metric_conn.query("unknown")
+
+
+def test_series_discovery_after_query(metric_conn: MetricConnection):
+    metric_conn.observe("lat", 1.0, labels={"route": "/a"})
+    assert metric_conn.query("lat").to_scaler() == 1.0
+
+    # Series created after the first query are still discovered
+    metric_conn.observe("lat", 2.0, labels={"route": "/b"})
+    metric_conn.increment("lat", labels={"route": "/c"})
+    assert len(metric_conn.query("lat")) == 3
+
+
+def test_fetch_uses_primary_key(metric_conn: MetricConnection):
+    plan = metric_conn._conn.execute(
+        "EXPLAIN QUERY PLAN " + Query._FETCH_STATEMENTS["metric_value"],
+        ("lat", 1, 0),
+    ).fetchall()
+    details = " ".join(row[-1] for row in plan)
+    assert "USING PRIMARY KEY" in details
+    assert "TEMP B-TREE" not in details
+
+
+def test_same_timestamp_keeps_order(metric_conn: MetricConnection):
+    metric_conn.observe_many([("lat", float(i), 100, None) for i in range(5)])
+    metric_conn.observe("lat", 5.0, ingest_time_us=100)
+    assert metric_conn.query("lat").to_array().tolist() == [0, 1, 2, 3, 4, 5]
+
+
+def test_serialize_labels():
+    assert _serialize_labels(None) == "null"
+    assert _serialize_labels({}) == "null"
+    assert _serialize_labels({"b": "1", "a": "2"}) == '{"a": "2", "b": "1"}'
+    assert _serialize_labels({"a": "2", "b": "1"}) == '{"a": "2", "b": "1"}'
+    # Equal values of different types are not mixed up by the memoization
+    assert _serialize_labels({"a": True}) == '{"a": true}'
+    assert _serialize_labels({"a": 1}) == '{"a": 1}'
+    # Unhashable values skip the memoization
+    assert _serialize_labels({"a": [1, 2]}) == '{"a": [1, 2]}'
+
+
+def test_background_writer_error(monkeypatch):
+    conn = MetricConnection(background_writer=True)
+    conn.observe("lat", 1.0)
+    conn.flush()
+
+    def failing_flush():
+        raise sqlite3.OperationalError("disk I/O error")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(conn, "_flush", failing_flush)
+        conn.observe("lat", 2.0)
+        with pytest.raises(sqlite3.OperationalError):
+            conn.flush()
+
+    # The writer survives the failed batch
+    conn.observe("lat", 3.0)
+    assert conn.query("lat").to_array().tolist() == [1.0, 3.0]
+    conn.close()
+    assert not conn._writer.is_alive()
+
+
+def test_parse_labels():
+    for labels in [None, {"a": "2", "b": 1}, {"a": [1, 2.5, True]}]:
+        assert _parse_labels(_serialize_labels(labels)) == (labels or None)
+    assert np.isnan(_parse_labels(_serialize_labels({"a": float("nan")}))["a"])
+
+
+def test_label_matching_fallback(metric_conn: MetricConnection):
+    metric_conn.observe("lat", 1.0, labels={"code": 200, "tags": ["a"]})
+    metric_conn.observe("lat", 2.0, labels={"code": 404, "tags": None})
+    metric_conn.observe("lat", 3.0, labels={"code": 404, "tags": ["a"]})
+
+    # Scalar values are matched in sqlite, others in Python
+    assert len(metric_conn.query("lat", labels={"code": 404})) == 2
+    assert len(metric_conn.query("lat", labels={"tags": ["a"]})) == 2
+    assert metric_conn.query("lat", labels={"tags": None}).to_scaler() == 2.0
+    query = metric_conn.query("lat", labels={"code": 404, "tags": ["a"]})
+    assert query.to_scaler() == 3.0
+    with pytest.raises(MetricNotFound):
+        metric_conn.query("lat", labels={"code": "404"})
+
+    # Labels sqlite cannot parse as JSON are matched in Python
+    metric_conn.observe("lat", 4.0, labels={"code": float("nan")})
+    assert len(metric_conn.query("lat", labels={"code": 404})) == 2
+    metric_conn.observe("lat", 5.0, labels={"code": 2**64})
+    assert metric_conn.query("lat", labels={"code": 2**64}).to_scaler() == 5.0
+
+
+def test_batch_matches_single_queries(metric_conn: MetricConnection):
+    for i in range(1, 11):
+        metric_conn.observe("lat", i, labels={"route": "/a"}, ingest_time_us=i * 1e6)
+        metric_conn.observe("lat", -i, labels={"route": "/b"}, ingest_time_us=i * 1e6)
+        metric_conn.observe("other", i, labels={"route": "/a"}, ingest_time_us=i * 1e6)
+
+    batch = metric_conn.query("lat").from_timestamp(4.0)
+    assert len(batch) == 2
+    for item in batch.to_array():
+        query = metric_conn.query("lat", labels=json.loads(item["labels"]))
+        expected = query.from_timestamp(4.0).to_array()
+        assert item["result"].tolist() == expected.tolist()
+        assert len(expected) == 6
+
+    for item in batch.to_percentiles([50]):
+        assert abs(item["result"][0]) == 7.5
+    for item in batch.to_timestamps():
+        assert item["result"].tolist()[0] == datetime.fromtimestamp(5)
+
+
+def test_batch_many_series(metric_conn: MetricConnection):
+    metric_conn.observe_many(
+        [("lat", i, None, {"id": i % 40}) for i in range(200)]
+        + [("other", 0, None, {"id": i}) for i in range(40)]
+    )
+    batch = metric_conn.query("lat")
+    assert len(batch) == 40
+    for item in batch.to_array():
+        series_id = json.loads(item["labels"])["id"]
+        assert item["result"].tolist() == list(range(series_id, 200, 40))
+
+
+def test_batch_to_scaler(metric_conn: MetricConnection):
+    metric_conn.observe_many(
+        [("lat", i, 1_000_000 * i, {"id": i % 3}) for i in range(30)]
+        + [("lat", 5, 0, {"id": 3})]
+    )
+    batch = metric_conn.query("lat").from_timestamp(2.0)
+    for agg in ["last", "min", "max", "mean", "count", "sum"]:
+        for item in batch.to_scaler(agg):
+            query = metric_conn.query("lat", labels=json.loads(item["labels"]))
+            assert item["result"] == query.from_timestamp(2.0).to_scaler(agg)
+    counts = {
+        json.loads(item["labels"])["id"]: item["result"]
+        for item in batch.to_scaler("count")
+    }
+    assert counts == {0: 9, 1: 9, 2: 9, 3: 0}
+
+
+def test_failed_write_recovers(metric_conn: MetricConnection, monkeypatch):
+    # Rows sqlite rejects fail their own call, the rest of the batch is kept
+    with pytest.raises(sqlite3.ProgrammingError):
+        metric_conn.observe("lat", decimal.Decimal("1.5"))
+    with pytest.raises(OverflowError):
+        with metric_conn:
+            metric_conn.observe("other", 1.0)
+            metric_conn.observe("other", 1.0, ingest_time_us=2**70)
+    assert not metric_conn.in_batch_context
+
+    metric_conn.observe("lat", 2.0)
+    metric_conn.observe("other", 3.0)
+    assert metric_conn.query("lat").to_array().tolist() == [2.0]
+    assert metric_conn.query("other").to_array().tolist() == [1.0, 3.0]
+
+    # A batch that fails to be written is dropped as a whole
+    def failing_flush():
+        raise sqlite3.OperationalError("disk I/O error")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(metric_conn, "_flush", failing_flush)
+        with pytest.raises(sqlite3.OperationalError):
+            metric_conn.observe("dropped", 1.0)
+    assert not metric_conn.in_batch_context
+    with pytest.raises(MetricNotFound):
+        metric_conn.query("dropped")
+    metric_conn.observe("dropped", 2.0)
+    assert metric_conn.query("dropped").to_array().tolist() == [2.0]
+
+
+def test_query_reads_buffered_rows(metric_conn: MetricConnection):
+    with metric_conn:
+        metric_conn.observe("lat", 1.0)
+        query = metric_conn.query("lat")
+        metric_conn.observe("lat", 2.0)
+        assert query.to_array().tolist() == [1.0, 2.0]
+        assert query.to_scaler() == 2.0
+
+        metric_conn.observe("lat", 3.0, labels={"r": "/a"})
+        batch = metric_conn.query("lat")
+        metric_conn.observe("lat", 4.0, labels={"r": "/a"})
+        assert sorted(item["result"] for item in batch.to_scaler()) == [2.0, 4.0]
+
+
+def test_series_from_other_connection(tmp_path):
+    db_path = str(tmp_path / "metrics.db")
+    conn = MetricConnection(db_path)
+    conn.observe("lat", 1.0, labels={"r": "/a"})
+    assert len(conn.query("lat").to_array()) == 1
+
+    other = MetricConnection(db_path, flush_db=False)
+    other.observe("lat", 2.0, labels={"r": "/b"})
+    assert len(conn.query("lat")) == 2
+    assert conn.query("lat", labels={"r": "/b"}).to_array().tolist() == [2.0]
+
+
+def test_writers_share_timestamps(tmp_path):
+    db_path = str(tmp_path / "metrics.db")
+    conn = MetricConnection(db_path)
+    other = MetricConnection(db_path, flush_db=False)
+    conn.observe("lat", 1.0, ingest_time_us=5)
+    other.observe("lat", 2.0, ingest_time_us=5)
+    conn.observe("lat", 3.0, ingest_time_us=5)
+    assert conn.query("lat").to_array().tolist() == [1.0, 2.0, 3.0]
+
+
+def test_older_schema_is_refused(tmp_path):
+    db_path = str(tmp_path / "metrics.db")
+    legacy_conn = sqlite3.connect(db_path)
+    legacy_conn.execute(
+        "CREATE TABLE metrics "
+        "(metric_name TEXT, metric_value REAL, ingest_time_us INTEGER, labels_json TEXT)"
+    )
+    legacy_conn.close()
+    with pytest.raises(ValueError):
+        MetricConnection(db_path, flush_db=False)
+    # Flushing recreates the tables
+    conn = MetricConnection(db_path)
+    conn.observe("lat", 1.0)
+    assert conn.query("lat").to_scaler() == 1.0
+
+
+def test_write_lock_held_elsewhere(tmp_path):
+    db_path = str(tmp_path / "metrics.db")
+    conn = MetricConnection(db_path)
+    conn._conn.execute("PRAGMA busy_timeout=0")
+    other = sqlite3.connect(db_path, isolation_level=None)
+    other.execute("BEGIN IMMEDIATE")
+    with pytest.raises(sqlite3.OperationalError):
+        conn.observe("lat", 1.0)
+    assert not conn.in_batch_context
+    other.execute("COMMIT")
+
+    conn.observe("lat", 2.0)
+    assert other.execute("SELECT count(*) FROM metrics").fetchone() == (1,)
+    conn.close()
+    conn.close()
+
+
 def test_empty_db_query(metric_conn: MetricConnection):
     with pytest.raises(MetricNotFound):
         metric_conn.query("not_found")
@@ -169,6 +584,56 @@ def test_batch_op(metric_conn: MetricConnection):
     assert len(arr) == 2
 
 
+def test_observe_many(metric_conn: MetricConnection):
+    metric_conn.observe_many(
+        [
+            ("lat", 1.0, 100, {"route": "/a"}),
+            ("lat", 2.0, 200, {"route": "/b"}),
+            ("lat", 3.0, 300, {"route": "/a"}),
+        ]
+    )
+    query = metric_conn.query("lat", labels={"route": "/a"})
+    assert query.to_array().tolist() == [1.0, 3.0]
+    assert metric_conn.query("lat", labels={"route": "/b"}).to_scaler() == 2.0
+
+    # Rows without a time share the time of the call, in order
+    metric_conn.observe_many([("now", float(i), None, None) for i in range(3)])
+    timestamps, values = metric_conn.query("now").to_timestamps_array()
+    assert len(set(timestamps.tolist())) == 1
+    assert values.tolist() == [0, 1, 2]
+
+
+def test_batch_buffer_flush(metric_conn: MetricConnection):
+    with metric_conn:
+        for i in range(metric_conn.MAX_PENDING_ROWS + 1):
+            metric_conn.observe("lat", i)
+        assert len(metric_conn._pending) == 1
+        # Reads flush the buffer first
+        assert len(metric_conn.query("lat").to_array()) == i + 1
+    assert len(metric_conn._pending) == 0
+    # The cache holds the last value of the batch
+    assert metric_conn.query("lat").to_scaler() == i
+
+
+def test_background_writer():
+    conn = MetricConnection(background_writer=True)
+    for i in range(100):
+        conn.observe("lat", i, labels={"route": "/a"})
+    conn.increment("counter", 2)
+    conn.increment("counter", 3)
+    with conn:
+        conn.observe("lat", 100, labels={"route": "/b"})
+
+    # Queries wait for the queued writes
+    assert conn.query("lat", labels={"route": "/a"}).to_array().tolist() == list(
+        range(100)
+    )
+    assert conn.query("lat", labels={"route": "/b"}).to_scaler() == 100
+    assert conn.query("counter").to_array().tolist() == [2, 5]
+    conn.close()
+    conn.close()
+
+
 def test_bench_ingestion(metric_conn: MetricConnection, benchmark):
     benchmark(lambda: metric_conn.observe("lat", 1.0))
 